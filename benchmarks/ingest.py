@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+# Compares tread's date parsing against dateutil on dates in the formats found
+# in real-world feeds. Run from the root of the repository with:
+#
+#     python -m benchmarks.ingest
+
+
+import random
+import warnings
+from datetime import datetime, timedelta
+from timeit import timeit
+from dateutil.parser import parse, UnknownTimezoneWarning
+
+from tread.ingest import parse_date
+
+
+# Dates as published: the examples in the RSS 2.0 and Atom specifications
+# and in RFC 2822 and RFC 3339, followed by the styles used by common feed
+# generators (WordPress, Blogger, GitHub, xkcd, etc.), quirks and all.
+REAL_WORLD = [
+    'Sat, 07 Sep 2002 00:00:01 GMT',
+    'Wed, 02 Oct 2002 08:00:00 EST',
+    'Wed, 02 Oct 2002 13:00:00 GMT',
+    'Wed, 02 Oct 2002 15:00:00 +0200',
+    'Tue, 10 Jun 2003 04:00:00 GMT',
+    'Tue, 03 Jun 2003 09:39:21 GMT',
+    '2003-12-13T18:30:02Z',
+    '2003-12-13T18:30:02.25Z',
+    '2003-12-13T18:30:02+01:00',
+    '2003-12-13T18:30:02.25+01:00',
+    '2005-07-31T12:29:29Z',
+    'Fri, 21 Nov 1997 09:55:06 -0600',
+    'Tue, 1 Jul 2003 10:52:37 +0200',
+    'Thu, 13 Feb 1969 23:32:54 -0330',
+    '21 Nov 97 09:55:06 GMT',
+    '1985-04-12T23:20:50.52Z',
+    '1996-12-19T16:39:57-08:00',
+    '1937-01-01T12:00:27.87+00:20',
+    'Mon, 06 Sep 2021 16:45:00 +0000',
+    'Wed, 18 Oct 2023 04:00:00 -0000',
+    'Mon, 15 Jan 2024 09:30:12 PST',
+    'Mon, 15 Jan 2024 09:30 GMT',
+    'Mon, 1 Jan 2024 00:00:00 UT',
+    '2024-01-15T09:30:12Z',
+    '2024-01-15T09:30:12+00:00',
+    '2024-01-15T09:30:00.001-08:00',
+    '2024-01-15T09:30:12.123456789Z',
+    '2024-01-15 09:30:12',
+]
+
+# Formats seen in the wild, from RSS pubDate and Atom/Dublin Core dates.
+FORMATS = [
+    '%a, %d %b %Y %H:%M:%S GMT',
+    '%a, %d %b %Y %H:%M:%S +0000',
+    '%a, %d %b %Y %H:%M:%S -0500',
+    '%a, %d %b %Y %H:%M:%S -0400',
+    '%a, %d %b %Y %H:%M:%S +0100',
+    '%a, %d %b %Y %H:%M GMT',
+    '%d %b %Y %H:%M:%S +0200',
+    '%a, %d %b %Y %H:%M:%S EST',
+    '%Y-%m-%dT%H:%M:%SZ',
+    '%Y-%m-%dT%H:%M:%S+00:00',
+    '%Y-%m-%dT%H:%M:%S.%f-07:00',
+    '%Y-%m-%d %H:%M:%S',
+]
+
+ROUNDS = 5
+
+
+def samples(count):
+    random.seed(0)
+    start = datetime(2015, 1, 1)
+
+    return [
+        (
+            start + timedelta(seconds=random.randrange(10 ** 9))
+        ).strftime(random.choice(FORMATS))
+        for _ in range(count)
+    ]
+
+
+def main():
+    warnings.simplefilter('ignore', UnknownTimezoneWarning)
+
+    # Real feeds repeat most of their dates from one refresh to the next, so
+    # parse each sample a few times over.
+    dates = samples(2000)
+    refreshes = dates * 10
+
+    # Make sure the results agree (both as instants and as the wall-clock
+    # time that is actually stored in the database). dateutil doesn't know
+    # every zone name (e.g., RFC 822's "UT"), so either may lack an offset.
+    for date in REAL_WORLD + dates:
+        fast, slow = parse_date(date), parse(date)
+        offsets = fast.utcoffset(), slow.utcoffset()
+        assert fast.replace(tzinfo=None) == slow.replace(tzinfo=None), date
+        assert offsets[0] == offsets[1] or None in offsets, date
+
+    def real_world():
+        for date in REAL_WORLD:
+            parse_date.__wrapped__(date)
+
+    def dateutil_real_world():
+        for date in REAL_WORLD:
+            parse(date)
+
+    def uncached():
+        parse_date.cache_clear()
+        for date in dates:
+            parse_date.__wrapped__(date)
+
+    def cached():
+        parse_date.cache_clear()
+        for date in refreshes:
+            parse_date(date)
+
+    def dateutil_once():
+        for date in dates:
+            parse(date)
+
+    def dateutil_refreshes():
+        for date in refreshes:
+            parse(date)
+
+    results = [
+        (name, count, timeit(function, number=ROUNDS))
+        for name, count, function in (
+            ('dateutil', len(REAL_WORLD), dateutil_real_world),
+            ('fast path', len(REAL_WORLD), real_world),
+            ('dateutil', len(dates), dateutil_once),
+            ('fast path', len(dates), uncached),
+            ('dateutil', len(refreshes), dateutil_refreshes),
+            ('fast path + cache', len(refreshes), cached),
+        )
+    ]
+
+    for name, count, seconds in results:
+        print(
+            '{:<20}{:>8} dates {:>10.1f} µs/date'.format(
+                name, count, seconds / ROUNDS / count * 10 ** 6
+            )
+        )
+
+    print(
+        'Speedup: {:.1f}x on published dates, {:.1f}x uncached, {:.1f}x with '
+        'repeated dates'.format(
+            *(results[i][2] / results[i + 1][2] for i in (0, 2, 4))
+        )
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -5,11 +5,15 @@
 
 
 import os
+import sys
 from argparse import ArgumentParser
 from curses import wrapper
 from functools import partial
+from dateutil.parser import parse
 
-from tread.controller import main, update_feeds
+from tread.controller import (
+    main, update_feeds, import_opml, export_opml, query
+)
 
 
 def console_main():
@@ -22,9 +26,77 @@ def console_main():
         '-u', '--update', help='Instead of running interactively, fetch '
         'updates for all feeds then exit.', action='store_true'
     )
+    parser.add_argument(
+        '--import-opml', metavar='OPML', help='Subscribe to all of the feeds '
+        'in an OPML file (adding them to the configuration file) then exit.'
+    )
+    parser.add_argument(
+        '--export-opml', help='Write subscribed feeds to stdout as OPML then '
+        'exit.', action='store_true'
+    )
+
+    query_group = parser.add_argument_group(
+        'export options', 'Stream feeds or items from the database to stdout. '
+        'With --list, the item filters limit which items are counted.'
+    )
+    query_mode = query_group.add_mutually_exclusive_group()
+    query_mode.add_argument(
+        '-l', '--list', help='List feeds (with item counts) then exit.',
+        action='store_true'
+    )
+    query_mode.add_argument(
+        '-e', '--export', help='Export items then exit.', action='store_true'
+    )
+    query_group.add_argument(
+        '-f', '--format', help='Output format. Defaults to jsonl (JSON '
+        'Lines).',
+        choices=('jsonl', 'opml'), default='jsonl'
+    )
+    query_group.add_argument(
+        '--feed', help='Only include the feed with this name or URL. May be '
+        'specified more than once.', action='append', dest='feeds'
+    )
+    query_group.add_argument(
+        '--unread', help='Only include unread items.', action='store_true'
+    )
+    query_group.add_argument(
+        '--starred', help='Only include starred items.', action='store_true'
+    )
+    query_group.add_argument(
+        '--since', help='Only include items published on or after this '
+        'date.', type=parse
+    )
+    query_group.add_argument(
+        '--until', help='Only include items published before this date.',
+        type=parse
+    )
+    query_group.add_argument(
+        '--text', metavar='WIDTH', help='Include a plain-text render of each '
+        'item (wrapped to WIDTH columns) in JSON Lines output.', type=int
+    )
     args = parser.parse_args()
 
-    if args.update:
+    if args.import_opml:
+        import_opml(
+            os.path.expanduser(args.config),
+            os.path.expanduser(args.import_opml)
+        )
+    elif args.export_opml:
+        export_opml(os.path.expanduser(args.config), sys.stdout)
+    elif args.list or args.export:
+        filters = {
+            'feeds': args.feeds, 'unread': args.unread,
+            'starred': args.starred, 'since': args.since, 'until': args.until
+        }
+        try:
+            query(
+                os.path.expanduser(args.config), sys.stdout, filters,
+                args.format, items=args.export, width=args.text
+            )
+        except BrokenPipeError:
+            # Output was piped to something (like head) that stopped reading.
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    elif args.update:
         update_feeds(os.path.expanduser(args.config))
     else:
         wrapper(
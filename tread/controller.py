@@ -1,19 +1,31 @@
 import os
+import multiprocessing
+import re
 import shutil
-import subprocess
-import requests
 import yaml
 import curses
 import webbrowser
-import re
-import imgii
+import time
 from datetime import datetime, timedelta, timezone
-from html2text import HTML2Text
+from itertools import islice
+from collections import deque
+from concurrent.futures import (
+    ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+)
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from wcwidth import wcswidth
 
-from .models import Base, Window, Feed
+from .models import (
+    Base, Window, Sidebar, Feed, FeedCache, feed_counts, download,
+    refreshed_since, migrate
+)
+from .render import Prefetcher
+from .fetch import Fetcher
+from .opml import read_opml, write_opml
+from .ingest import parse_feed
+from .export import list_feeds, export_items
+from .snapshot import load_snapshot, save_snapshot
 
 
 LOGO = [
@@ -27,25 +39,139 @@ LOGO = [
 
 def update_feeds(config_file):
     # Load configuration.
-    with open(config_file) as f:
-        config = yaml.load(f)
+    config = read_config(config_file)
 
     # Set up database and requests sessions.
-    db_session, www_session = configure_sessions(config)
+    db_session, fetcher = configure_sessions(config)
 
-    for feed in config.get('feeds', []):
-        # Load feeds from the database.
-        row = db_session.query(Feed).filter(Feed.url == feed['url']).scalar()
+    # Load feeds from the database.
+    feeds = load_feeds(db_session, config.get('feeds', []))
 
-        if row:
-            row.name = feed.get('name', row.name)
-        else:
-            row = Feed(feed.get('name', feed['url']), feed['url'])
-            db_session.add(row)
-            db_session.commit()
+    # Feeds are downloaded concurrently and (optionally) parsed in a process
+    # pool, but only this thread writes to the database.
+    processes = config.get('parse_processes', 0)
+    downloads = ThreadPoolExecutor(
+        max_workers=config.get('download_workers', 8)
+    )
+    parsers = None
+    if processes:
+        # Parser processes are started while download threads are mid-request,
+        # and forking a multithreaded process can deadlock the child. Start
+        # them from a clean server process instead, where that's available.
+        methods = multiprocessing.get_all_start_methods()
+        parsers = ProcessPoolExecutor(
+            max_workers=processes, mp_context=multiprocessing.get_context(
+                'forkserver' if 'forkserver' in methods else None
+            )
+        )
+
+    jobs = {}
+    for feed in feeds:
+        print('Refreshing {}...'.format(feed.name))
+        future = downloads.submit(
+            download, fetcher, feed.url, config.get('timeout')
+        )
+        jobs[future] = feed
+
+    while jobs:
+        done, _ = wait(jobs, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            feed = jobs.pop(future)
+
+            try:
+                result = future.result()
+            except Exception as e:
+                print('Unable to parse {}: {}'.format(feed.url, e))
+                continue
+
+            if result is None:
+                # Download failed (and has already been logged).
+                continue
+
+            if isinstance(result, str):
+                if parsers:
+                    jobs[parsers.submit(parse_feed, result)] = feed
+                    continue
+
+                try:
+                    result = parse_feed(result)
+                except Exception as e:
+                    print('Unable to parse {}: {}'.format(feed.url, e))
+                    continue
+
+            # Update feed items.
+            feed.update(db_session, result)
+
+    downloads.shutdown()
+    if parsers:
+        parsers.shutdown()
+
+
+def import_opml(config_file, opml_file):
+    if not os.path.isfile(config_file) and not create_config(config_file):
+        print(f'No configuration file found at {config_file}.')
+        return
+
+    # Load configuration.
+    config = read_config(config_file)
+    config['feeds'] = config.get('feeds') or []
+
+    # Find the feeds that aren't already subscribed.
+    subscribed = {feed['url'] for feed in config['feeds']}
+    new_feeds = []
+    for feed in read_opml(opml_file):
+        if feed['url'] not in subscribed:
+            subscribed.add(feed['url'])
+            new_feeds.append(feed)
+
+    # Add them to the configuration file as text, so that the rest of the
+    # file (comments and all) is left exactly as it was.
+    with open(config_file) as f:
+        text = add_feeds(f.read(), new_feeds)
+
+    if new_feeds and (yaml.safe_load(text) or {}).get('feeds') != (
+        config['feeds'] + new_feeds
+    ):
+        print(
+            f'Unable to add feeds to {config_file}. Add them to the feeds '
+            f'list by hand:\n\n{feed_yaml(new_feeds)}'
+        )
+        return
+
+    with open(config_file, 'w') as f:
+        f.write(text)
+
+    config['feeds'] += new_feeds
+
+    # Register the new feeds with the database all at once.
+    db_session, _ = configure_sessions(config)
+    feeds = load_feeds(db_session, config['feeds'])
+
+    print(f'{len(feeds)} feeds subscribed.')
+
+
+def export_opml(config_file, stream):
+    # Load configuration.
+    config = read_config(config_file)
+
+    # Set up database session.
+    db_session, _ = configure_sessions(config)
 
-        # Update feed items.
-        row.refresh(db_session, www_session, config.get('timeout'))
+    write_opml(load_feeds(db_session, config.get('feeds', [])), stream)
+
+
+def query(config_file, stream, filters, fmt='jsonl', items=True, width=None):
+    # Load configuration.
+    config = read_config(config_file)
+
+    # Set up database session.
+    db_session, _ = configure_sessions(config)
+
+    if items:
+        export_items(db_session, stream, filters, fmt, config, width)
+    else:
+        list_feeds(db_session, stream, filters, fmt)
 
 
 def main(screen, config_file):
@@ -53,14 +179,7 @@ def main(screen, config_file):
     missing_config = not os.path.isfile(config_file)
 
     if missing_config:
-        # Write default configuration to config file location.
-        sample_config = os.path.realpath(
-            os.path.join(os.path.dirname(__file__), 'default_config.yml')
-        )
-        missing_sample = not os.path.isfile(sample_config)
-
-        if not missing_sample:
-            shutil.copyfile(sample_config, config_file)
+        missing_sample = not create_config(config_file)
 
     # Load configuration.
     config_load_error = None
@@ -75,7 +194,10 @@ def main(screen, config_file):
     config['keys'] = configure_keys(config.get('keys', dict()))
 
     # Set up database and requests sessions.
-    db_session, www_session = configure_sessions(config)
+    db_session, fetcher = configure_sessions(config)
+
+    # Render items in the background so they're ready before they're opened.
+    prefetcher = Prefetcher(config, fetcher)
 
     # This is the only time the whole screen is ever refreshed. But if you
     # don't refresh it, screen.getkey will clear it, because curses is awful.
@@ -94,11 +216,13 @@ def main(screen, config_file):
     menu.write(menu_text(config['keys'], menu.width))
     menu.refresh()
 
+    # Keep recent messages, so they can be rewritten after a resize.
+    history = deque(maxlen=config.get('message_history', 50))
+
     # Add loading message.
     def log(message):
-        messages.write(
-            f'{datetime.now():%Y-%m-%d %H:%M}: {message}', autoscroll=True
-        )
+        history.append(f'{datetime.now():%Y-%m-%d %H:%M}: {message}')
+        messages.write(history[-1], autoscroll=True)
         messages.refresh()
 
     if missing_config and missing_sample:
@@ -115,68 +239,153 @@ def main(screen, config_file):
     if config_load_error:
         log(config_load_error)
 
+    # Paint the first frame from what was on screen last time, before
+    # anything else is loaded.
+    # Kept next to the database, so that each database gets its own.
+    snapshot_file = os.path.expanduser(
+        config.get(
+            'snapshot', config.get('database', '~/.tread.db') + '.snapshot'
+        )
+    )
+    snapshot = load_snapshot(snapshot_file)
+    if snapshot:
+        draw_snapshot(snapshot, sidebar, content)
+
     # Load feeds from the DB.
-    feeds = []
-    for feed in config['feeds']:
-        row = db_session.query(Feed).filter(Feed.url == feed['url']).scalar()
+    feeds = load_feeds(db_session, config['feeds'])
 
-        if row:
-            row.name = feed.get('name', row.name)
-        else:
-            row = Feed(feed.get('name', feed['url']), feed['url'])
-            db_session.add(row)
-            db_session.commit()
+    # Initial selections.
+    urls = [feed.url for feed in feeds]
+    selected_feed = (
+        urls.index(snapshot['selected'])
+        if snapshot and snapshot.get('selected') in urls else 0
+    )
 
-        feeds.append(row)
+    # Feeds are refreshed in the background; the results are written to the
+    # database by the main loop.
+    refresher = ThreadPoolExecutor(max_workers=1)
+    refreshing = {}
 
-    # Initial selections.
     if (len(feeds) > 0) and (
-        (feeds[0].last_refresh is None) or (
-            datetime.utcnow() - feeds[0].last_refresh >
+        (feeds[selected_feed].last_refresh is None) or (
+            datetime.utcnow() - feeds[selected_feed].last_refresh >
             timedelta(minutes=config.get('refresh', 10))
         )
     ):
-        feeds[0].refresh(db_session, www_session, config.get('timeout'), log)
+        log('Refreshing {}...'.format(feeds[selected_feed].name))
+        future = refresher.submit(
+            fetch_feed, fetcher, feeds[selected_feed].url,
+            config.get('timeout'), prefetcher.messages.put
+        )
+        refreshing[future] = feeds[selected_feed]
+
+    def feed_labels(indices):
+        shown = [feeds[i] for i in indices]
+
+        if not config.get('unread_count'):
+            return [feed.name for feed in shown]
+
+        # Add optional unread count to feed name display.
+        counts = feed_counts(db_session, [feed.id for feed in shown])
+        labels = []
+        for feed in shown:
+            unread, starred = counts[feed.id]
+            starred = ', *{}'.format(starred) if starred else ''
+            labels.append('{} ({}{})'.format(feed.name, unread, starred))
+
+        return labels
+
+    # Only the visible part of the feed list is ever drawn.
+    sidebar.show(len(feeds), selected_feed, feed_labels)
+
+    # Keep only the recently viewed feeds' items in memory.
+    cache = FeedCache(
+        db_session, config.get('resident_feeds', 3),
+        config.get('resident_items', 2000)
+    )
 
     item_open = False
     autoscroll_to_item = False
-    redraw_sidebar = True
     redraw_content = True
-    selected_feed = 0
+    retry_images = False
     selected_item = 0
+    content.clear()
 
-    # TODO: Add ability to do 10j or 10<DOWN_ARROW>, like in vim. Clear it
-    # whenever a non-numeric key is hit.
-
-    # TODO: Add g/gg (or something) for top/bottom of feed items
+    # Vim-style count prefix (e.g., 10J) and the previous key (for gg).
+    count = 0
+    previous_key = None
+    pending_key = None
 
     # TODO: Feed selection, item selection, etc. should probably be abstracted
     # into an object as well. These loops are really awkward.
 
-    while True:
-        current_feed = feeds[selected_feed] if feeds else None
-        current_item = (
-            current_feed.items[selected_item] if current_feed else None
-        )
+    def mark_read(item, read=True):
+        # Copies of the item in other feeds are marked too.
+        changed = item.set_read(db_session, read)
+        db_session.commit()
 
-        if redraw_sidebar:
-            redraw_sidebar = False
-            for i, feed in enumerate(feeds):
-                # Add optional unread count to feed name display.
-                display_name = feed.name
-                if config.get('unread_count'):
-                    display_name += ' ({}{})'.format(
-                        feed.unread,
-                        ', *{}'.format(feed.starred) if feed.starred else ''
-                    )
+        for feed_id in changed:
+            if feed_id in feed_index:
+                sidebar.update(feed_index[feed_id])
+
+    # Watch for feeds refreshed by another process (e.g., tread --update run
+    # by cron). Waiting for input times out so that the check still happens.
+    feed_index = {feed.id: i for i, feed in enumerate(feeds)}
+    last_seen, _ = refreshed_since(db_session, None)
+    poll_interval = config.get('poll_interval', 5)
+    next_poll = time.monotonic() + poll_interval
+    wait = int(poll_interval * 1000) if poll_interval else -1
+    screen.timeout(wait)
 
-                sidebar.write(
-                    '{:{}}'.format(display_name, sidebar.width), row_offset=i,
-                    attr=curses.A_BOLD | curses.A_REVERSE * (i==selected_feed)
+    while True:
+        # Write the results of any finished background refreshes.
+        for future in [future for future in refreshing if future.done()]:
+            feed = refreshing.pop(future)
+            parsed = future.result()
+
+            if parsed:
+                feed.update(db_session, parsed)
+
+                # Check for changes right away to redraw the feed.
+                next_poll = 0
+
+        if (poll_interval or next_poll == 0) and (
+            time.monotonic() >= next_poll
+        ):
+            next_poll = time.monotonic() + poll_interval
+            last_seen, changed = refreshed_since(db_session, last_seen)
+
+            for feed_id in changed:
+                i = feed_index.get(feed_id)
+
+                if i is None:
+                    continue
+                elif i != selected_feed:
+                    feeds[i].reload(db_session)
+                    sidebar.update(i)
+                    continue
+
+                # Keep the same item selected, even if new items came in.
+                items = feeds[i].items
+                selected_id = items[selected_item].id if items else None
+                feeds[i].reload(db_session)
+                ids = [item.id for item in feeds[i].items]
+                selected_item = (
+                    ids.index(selected_id) if selected_id in ids else 0
                 )
 
-            # Refresh sidebar.
-            sidebar.refresh()
+                sidebar.update(i)
+                content.clear()     # Should be more selective.
+                redraw_content = True
+
+        current_feed = feeds[selected_feed] if feeds else None
+        if current_feed:
+            cache.touch(current_feed)
+
+        current_item = (
+            current_feed.items[selected_item]
+            if current_feed and current_feed.items else None
+        )
 
         if redraw_content:
             redraw_content = False
@@ -187,19 +396,9 @@ def main(screen, config_file):
                         curses.A_BOLD * (not item.read)
                     )
 
-                    # Use manual padding calcuations because Python's built-in
-                    # string formatting doesn't play nicely with double-width
-                    # Unicode characters
-                    disp_title = ("* " if item.starred else "") + item.title
-                    width = wcswidth(disp_title)
-
-                    # Is there space to display the pubdate?
-                    show_date = width + 16 < content.width
-                    padding = content.width - width - 16 * show_date
                     content.write(
-                        f'{disp_title}{padding * " "}' + (
-                            f'{to_local(item.date):%Y-%m-%d %H:%M}'
-                            if show_date else ''
+                        item_line(
+                            item.title, item.starred, item.date, content.width
                         ),
                         row_offset=0 if i == 0 else None,
                         attr=attributes
@@ -219,14 +418,25 @@ def main(screen, config_file):
                             autoscroll_to_item = False
 
                         if item_open:
-                            # Parse the HTML content.
-                            parsed_string = parse_content(
-                                item.content, config, content.width, log
+                            # Parse the HTML content (if it hasn't already
+                            # been rendered in the background).
+                            parsed_string = prefetcher.render(
+                                item, content.width, retry_images
                             )
+                            retry_images = False
 
                             # Print it to the screen.
                             content.write(f'\n{parsed_string}')
 
+                # Start rendering the items the user is likely to read next.
+                prefetcher.prefetch(
+                    prefetch_targets(
+                        current_feed.items, selected_item,
+                        config.get('prefetch', 3)
+                    ),
+                    content.width
+                )
+
             else:
                 log(
                     'No feeds to display. Instructions for adding feeds are '
@@ -235,20 +445,79 @@ def main(screen, config_file):
 
             content.refresh()
 
-        # Block, waiting for input.
-        try:
-            key = screen.getkey().upper()
-        except:
-            # On resize, getkey screws up once (maybe more).
-            pass
+        # Display any messages from background rendering.
+        prefetcher.flush(log)
+
+        # Block, waiting for input (or until it's time to check for changes).
+        if pending_key is not None:
+            raw_key, pending_key = pending_key, None
+        else:
+            # Check back frequently while feeds are being refreshed.
+            screen.timeout(100 if refreshing else wait)
+            raw_key = read_key(screen)
+
+        if raw_key is None:
+            # Timed out; keep any count or g that is still being typed.
+            continue
+
+        key = raw_key.upper()
+
+        if raw_key in '0123456789' and (count or raw_key != '0'):
+            count = count * 10 + int(raw_key)
+            continue
+
+        # Work out where movement keys (including any count) lead.
+        target = None
+        if current_feed and current_feed.items:
+            length = len(current_feed.items)
+            moving = (config['keys']['next_item'], config['keys']['prev_item'])
+
+            if key in moving:
+                step = (count or 1) * (1 if key == moving[0] else -1)
+
+                # Apply any movement keys that are already waiting (e.g., when
+                # J is held down) all at once, with a single redraw.
+                moves, pending_key = drain_moves(screen, config['keys'], wait)
+                target = selected_item + step + moves
+
+                # Plain J/K wrap around, but a count stops at either end (as
+                # in vim, and like G).
+                if count:
+                    target = min(max(target, 0), length - 1)
+                else:
+                    target %= length
+
+            elif key == config['keys']['first_item'] or (
+                raw_key == 'g' and previous_key == 'g'
+            ):
+                target = 0
+
+            elif key == config['keys']['last_item'] or raw_key == 'G':
+                target = min(count, length) - 1 if count else length - 1
+
+        previous_key = raw_key if target is None else None
+        count = 0
 
         if key == 'KEY_RESIZE':
+            # Wait for the terminal to stop changing size before redrawing.
+            pending_key = settle_resize(
+                screen, wait, config.get('resize_delay', 0.2)
+            )
+
             resize(content, logo, sidebar, menu, messages)
             draw_logo(logo)
             menu.write(menu_text(config['keys'], menu.width), row_offset=0)
             menu.refresh()
+
+            messages.next_row = 0
+            for message in history:
+                messages.write(message, autoscroll=True)
+            messages.refresh()
+
+            # Rendered items are reflowed to the new width from cached images,
+            # so this doesn't fetch anything.
+            content.clear()
             redraw_content = True
-            redraw_sidebar = True
 
         elif key == config['keys']['open'] and current_item:
             content.clear()     # Should be more selective.
@@ -256,41 +525,26 @@ def main(screen, config_file):
             item_open = not item_open
 
             if item_open:
-                current_item.read = True
-                db_session.commit()
+                mark_read(current_item)
+                retry_images = True
             else:
                 # When closed, title might be off the screen now.
                 autoscroll_to_item = True
 
-        elif key == config['keys']['next_item'] and current_feed:
-            if len(current_feed.items) > 0:
-                content.clear()     # Should be more selective.
-                redraw_content = True
-                selected_item = (selected_item + 1) % len(current_feed.items)
-                autoscroll_to_item = True
-
-                if item_open:
-                    current_feed.items[selected_item].read = True
-                    db_session.commit()
-                    redraw_sidebar = True
-
-        elif key == config['keys']['prev_item'] and current_feed:
-            if len(current_feed.items) > 0:
-                content.clear()     # Should be more selective.
-                redraw_content = True
-                selected_item = (selected_item - 1) % len(current_feed.items)
-                autoscroll_to_item = True
+        elif target is not None:
+            content.clear()     # Should be more selective.
+            redraw_content = True
+            selected_item = target
+            autoscroll_to_item = True
 
-                if item_open:
-                    current_feed.items[selected_item].read = True
-                    db_session.commit()
-                    redraw_sidebar = True
+            # Only the item that the selection lands on is marked as read.
+            if item_open:
+                mark_read(current_feed.items[selected_item])
+                retry_images = True
 
         elif key == config['keys']['next_feed'] and current_feed:
             content.clear()     # Should be more selective.
-            sidebar.clear()     # Should be more selective.
             redraw_content = True
-            redraw_sidebar = True
 
             selected_feed = (selected_feed + 1) % len(feeds)
             selected_item = 0
@@ -302,14 +556,14 @@ def main(screen, config_file):
                     timedelta(minutes=config.get('refresh', 10))
             ):
                 feeds[selected_feed].refresh(
-                    db_session, www_session, config.get('timeout'), log
+                    db_session, fetcher, config.get('timeout'), log, retries=0
                 )
 
+            sidebar.select(selected_feed)
+
         elif key == config['keys']['prev_feed'] and current_feed:
             content.clear()     # Should be more selective.
-            sidebar.clear()     # Should be more selective.
             redraw_content = True
-            redraw_sidebar = True
 
             selected_feed = (selected_feed - 1) % len(feeds)
             selected_item = 0
@@ -321,9 +575,11 @@ def main(screen, config_file):
                     timedelta(minutes=config.get('refresh', 10))
             ):
                 feeds[selected_feed].refresh(
-                    db_session, www_session, config.get('timeout'), log
+                    db_session, fetcher, config.get('timeout'), log, retries=0
                 )
 
+            sidebar.select(selected_feed)
+
         elif key == config['keys']['scroll_down']:
             content.scroll_down(config.get('scroll_lines', 5))
 
@@ -332,17 +588,17 @@ def main(screen, config_file):
 
         elif key == config['keys']['update_feed'] and current_feed:
             content.clear()     # Should be more selective.
-            sidebar.clear()     # Should be more selective.
             redraw_content = True
-            redraw_sidebar = True
 
             selected_item = 0
             item_open = False
             autoscroll_to_item = True
 
+            # The interface waits on this, so don't back off and retry.
             feeds[selected_feed].refresh(
-                db_session, www_session, config.get('timeout'), log
+                db_session, fetcher, config.get('timeout'), log, retries=0
             )
+            sidebar.update(selected_feed)
 
         elif key == config['keys']['open_in_browser'] and current_item:
             if current_item.url:
@@ -353,38 +609,148 @@ def main(screen, config_file):
         elif key == config['keys']['toggle_read'] and current_item:
             # Should be more selective.
             redraw_content = True
-            redraw_sidebar = True
-            current_item.read = not current_item.read
-            db_session.commit()
+            mark_read(current_item, not current_item.read)
 
         elif key == config['keys']['toggle_star'] and current_item:
             # Should be more selective.
             redraw_content = True
-            redraw_sidebar = True
             current_item.starred = not current_item.starred
             db_session.commit()
+            sidebar.update(selected_feed)
+
+        elif key == config['keys']['debug']:
+            items, size = cache.stats()
+            renders, render_size = prefetcher.stats()
+            log(
+                f'{items} items resident (~{size // 1024} KiB), {renders} '
+                f'rendered items cached (~{render_size // 1024} KiB).'
+            )
 
         elif key == config['keys']['quit']:
+            # Stop any downloads in progress, so exiting doesn't wait on them.
+            fetcher.close()
+            prefetcher.shutdown()
+            refresher.shutdown(wait=False, cancel_futures=True)
+
+            if feeds:
+                save_snapshot(
+                    snapshot_file, take_snapshot(
+                        feeds, selected_feed, feed_labels, content.height,
+                        sidebar.height
+                    )
+                )
             break
 
 
+def read_config(config_file):
+    with open(config_file) as f:
+        return yaml.safe_load(f) or {}
+
+
+def create_config(config_file):
+    # Write default configuration to config file location.
+    sample_config = os.path.realpath(
+        os.path.join(os.path.dirname(__file__), 'default_config.yml')
+    )
+
+    if not os.path.isfile(sample_config):
+        return False
+
+    shutil.copyfile(sample_config, config_file)
+    return True
+
+
+def add_feeds(text, feeds):
+    if not feeds:
+        return text
+
+    lines = text.splitlines(keepends=True)
+    if lines and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+
+    start = next(
+        (
+            i for i, line in enumerate(lines)
+            if re.match(r'feeds:\s*(\[\s*\]\s*)?(#.*)?$', line)
+        ),
+        None
+    )
+
+    if start is None:
+        return ''.join(lines) + 'feeds:\n' + feed_yaml(feeds, '  ')
+
+    # An empty flow-style list ("feeds: []") becomes a block-style list.
+    lines[start] = re.sub(r'\[\s*\]\s*', '', lines[start])
+
+    # The list runs until the next line that isn't indented, an item, blank
+    # or a comment. New feeds go after its last item, indented to match.
+    end = start
+    indent = None
+    for i in range(start + 1, len(lines)):
+        line = lines[i]
+
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        if not (line[0].isspace() or line.startswith('-')):
+            break
+
+        end = i
+        if indent is None and line.lstrip().startswith('-'):
+            indent = line[:len(line) - len(line.lstrip())]
+
+    lines.insert(end + 1, feed_yaml(feeds, '  ' if indent is None else indent))
+
+    return ''.join(lines)
+
+
+def feed_yaml(feeds, indent=''):
+    entries = yaml.safe_dump(
+        [{'name': feed['name'], 'url': feed['url']} for feed in feeds],
+        sort_keys=False, allow_unicode=True, width=float('inf')
+    )
+
+    return ''.join(indent + line for line in entries.splitlines(True))
+
+
+def load_feeds(db_session, feed_config):
+    # Fetch every known feed with a single query, rather than one per feed.
+    rows = {row.url: row for row in db_session.query(Feed)}
+
+    feeds = []
+    for feed in feed_config:
+        row = rows.get(feed['url'])
+
+        if row:
+            row.name = feed.get('name', row.name)
+        else:
+            row = Feed(feed.get('name', feed['url']), feed['url'])
+            rows[row.url] = row
+            db_session.add(row)
+
+        feeds.append(row)
+
+    # Write any new feeds (or new names) back in a single transaction, then
+    # reload the (now expired) rows with one query instead of one per feed.
+    db_session.commit()
+    db_session.query(Feed).all()
+
+    return feeds
+
+
 def configure_sessions(config):
     # Set up database session.
     db_path = os.path.expanduser(config.get('database', '~/.tread.db'))
     db_uri = f'sqlite:///{db_path}'
     engine = create_engine(db_uri)
     Base.metadata.create_all(engine)
+    migrate(engine)
     Session = sessionmaker(bind=engine)
     db_session = Session()
 
-    # Set up requests to fetch data with retries.
-    www_session = requests.Session()
-    adapter = requests.adapters.HTTPAdapter(
-        max_retries=config.get('retries', 10)
-    )
-    www_session.mount('https://', adapter)
+    # Set up requests to fetch data with per-host limits and retries.
+    fetcher = Fetcher(config)
 
-    return (db_session, www_session)
+    return (db_session, fetcher)
 
 
 def init_windows(screen, config):
@@ -397,11 +763,9 @@ def init_windows(screen, config):
         screen, *logo_dimensions(), max_lines=len(LOGO), border=False
     )
 
-    sidebar = Window(
-        screen, *sidebar_dimensions(), max_lines=100, title='FEEDS'
-    )
+    sidebar = Sidebar(screen, *sidebar_dimensions(), title='FEEDS')
 
-    menu = Window(screen, *menu_dimensions(), max_lines=8, title='KEYS')
+    menu = Window(screen, *menu_dimensions(), max_lines=11, title='KEYS')
 
     messages = Window(
         screen, *message_dimensions(), max_lines=10, title='MESSAGES'
@@ -410,63 +774,136 @@ def init_windows(screen, config):
     return (content, logo, sidebar, menu, messages)
 
 
-def parse_content(content, config, width, log):
-    browser = config.get('parser', 'html2text')
-    images = config.get('ascii_images')
-    chars = imgii.BLOCKS if config.get('image_blocks') else imgii.CHARS
+def read_key(screen):
+    try:
+        return screen.getkey()
+    except:
+        # On resize, getkey screws up once (maybe more). It also raises an
+        # error when it times out.
+        return None
 
-    # TODO: Cache all ASCII images in a dict by URL.
 
-    if images:
-        # Replace images with placeholder text, because (especially if using
-        # block characters) the images don't always survive parsing.
-        content = re.sub(
-            r'(<img\s.*?src="(https?://.+?)"[^>]*?>)',
-            r'<br/>TREAD_PLACEHOLDER \2 END_PLACEHOLDER<br/>\1',
-            content
-        )
+def drain_moves(screen, keys, wait):
+    moves = 0
+    pending_key = None
 
-    if browser == 'lynx':
-        output = subprocess.check_output(
-            [
-                'lynx',
-                '-stdin', '-dump', '-width', str(width + 2), '-image_links'
-            ],
-            input=content.encode('iso-8859-1', 'xmlcharrefreplace'),
-            stderr=subprocess.STDOUT
-        )
-        output = output.decode('iso-8859-1', 'xmlcharrefreplace')
-        output += '\n'
-
-    elif browser == 'w3m':
-        output = subprocess.check_output(
-            ['w3m', '-T', 'text/html', '-dump', '-cols', str(width)],
-            input=content.encode('utf-8', 'xmlcharrefreplace'),
-            stderr=subprocess.STDOUT
-        )
-        output = output.decode('utf-8', 'xmlcharrefreplace')
+    # Read without blocking until something other than a movement key comes
+    # up, which is returned so that it can be handled normally.
+    screen.timeout(0)
+    while True:
+        raw_key = read_key(screen)
+
+        if raw_key is None:
+            break
+        elif raw_key.upper() == keys['next_item']:
+            moves += 1
+        elif raw_key.upper() == keys['prev_item']:
+            moves -= 1
+        else:
+            pending_key = raw_key
+            break
 
-    elif browser == 'html2text':
-        handler = HTML2Text()
-        handler.body_width = width - 1
-        output = handler.handle(content)
+    screen.timeout(wait)
 
-    else:
-        log(f'Unsuported browser: {browser}')
-        return content
-
-    if images:
-        output = re.sub(
-            r'\n? *TREAD_PLACEHOLDER[\s\n]+?(.+?)[\s\n]+?END_PLACEHOLDER',
-            lambda m: '\n   ' + imgii.image_to_ascii(
-                re.sub(r'[\s\n]', '', m.group(1)),
-                url=True, console_width=width - 7, chars=chars
-            ).replace('\n', '\n   '),
-            output,
-            flags=re.DOTALL
+    return moves, pending_key
+
+
+def fetch_feed(fetcher, url, timeout, log):
+    # Download and parse a feed without touching the database, so that it can
+    # be done in the background.
+    xml = download(fetcher, url, timeout, log)
+
+    try:
+        return parse_feed(xml) if xml is not None else None
+    except Exception as e:
+        log('Unable to parse {}: {}'.format(url, e))
+        return None
+
+
+def take_snapshot(feeds, selected, labels, height, rows):
+    items = feeds[selected].items[:height]
+
+    # Only the feeds that could be visible around the selection are needed
+    # (allowing for the sidebar to be a little taller next time).
+    first = max(selected - rows, 0)
+    last = min(selected + rows, len(feeds))
+
+    return {
+        'labels': labels(range(first, last)),
+        'first': first,
+        'count': len(feeds),
+        'selected': feeds[selected].url,
+        'index': selected,
+        'items': [
+            {
+                'title': item.title, 'starred': item.starred,
+                'read': item.read, 'date': item.date.isoformat()
+            }
+            for item in items
+        ],
+    }
+
+
+def draw_snapshot(snapshot, sidebar, content):
+    labels = snapshot.get('labels', [])
+    first = snapshot.get('first', 0)
+    count = snapshot.get('count', len(labels))
+
+    def label(indices):
+        return [
+            labels[i - first] if 0 <= i - first < len(labels) else ''
+            for i in indices
+        ]
+
+    sidebar.show(
+        count, min(snapshot.get('index', 0), max(count - 1, 0)), label
+    )
+
+    for i, item in enumerate(snapshot.get('items', [])):
+        content.write(
+            item_line(
+                item['title'], item['starred'],
+                datetime.fromisoformat(item['date']), content.width
+            ),
+            row_offset=0 if i == 0 else None,
+            attr=(
+                curses.A_REVERSE * (i == 0) |
+                curses.A_BOLD * (not item['read'])
+            )
         )
 
-    return output
+    content.refresh()
+
+
+def settle_resize(screen, wait, delay):
+    pending_key = None
+
+    # Discard resize events until none have arrived for delay seconds. Any
+    # other key is returned so that it can be handled normally.
+    screen.timeout(int(delay * 1000))
+    while True:
+        raw_key = read_key(screen)
+
+        if raw_key != 'KEY_RESIZE':
+            pending_key = raw_key
+            break
+
+    screen.timeout(wait)
+
+    return pending_key
+
+
+def prefetch_targets(items, selected, count):
+    if not items:
+        return []
+
+    # Adjacent items, followed by the next few unread items.
+    adjacent = [items[(selected + i) % len(items)] for i in (1, -1)]
+    unread = islice(
+        (item for item in items[selected + 1:] if not item.read), count
+    )
+
+    return adjacent + list(unread)
 
 
 def configure_keys(existing):
@@ -474,6 +911,8 @@ def configure_keys(existing):
         'open': ' ',
         'prev_item': 'K',
         'next_item': 'J',
+        'first_item': 'KEY_HOME',
+        'last_item': 'KEY_END',
         'prev_feed': 'H',
         'next_feed': 'L',
         'update_feed': 'U',
@@ -482,7 +921,8 @@ def configure_keys(existing):
         'toggle_read': 'R',
         'toggle_star': 'S',
         'open_in_browser': 'O',
-        'quit': 'Q'
+        'quit': 'Q',
+        'debug': 'D'
     }
 
     # Make uppercase.
@@ -511,6 +951,10 @@ def menu_text(keys, width):
             'Prev/Next Item:', key_width,
             disp['prev_item'] + '/' + disp['next_item'], value_width
         ),
+        menu_format.format(
+            'First/Last Item:', key_width,
+            disp['first_item'] + '/' + disp['last_item'], value_width
+        ),
         menu_format.format(
             'Prev/Next Feed:', key_width,
             disp['prev_feed'] + '/' + disp['next_feed'], value_width
@@ -531,6 +975,9 @@ def menu_text(keys, width):
         menu_format.format(
             'Open in Browser:', key_width, disp['open_in_browser'], value_width
         ),
+        menu_format.format(
+            'Memory Use:', key_width, disp['debug'], value_width
+        ),
         menu_format.format('Quit', key_width, disp['quit'], value_width),
     ]
 
@@ -560,7 +1007,7 @@ def logo_height():
 
 def menu_height():
     # Menu height should be a quarter of screen up to the number of menu items.
-    return min(9 + 2 * Window.border_height, curses.LINES // 4)
+    return min(11 + 2 * Window.border_height, curses.LINES // 4)
 
 
 def message_height():
@@ -607,5 +1054,20 @@ def draw_logo(window):
     window.refresh()
 
 
+def item_line(title, starred, date, width):
+    # Use manual padding calcuations because Python's built-in string
+    # formatting doesn't play nicely with double-width Unicode characters
+    disp_title = ("* " if starred else "") + title
+    title_width = wcswidth(disp_title)
+
+    # Is there space to display the pubdate?
+    show_date = title_width + 16 < width
+    padding = width - title_width - 16 * show_date
+
+    return f'{disp_title}{padding * " "}' + (
+        f'{to_local(date):%Y-%m-%d %H:%M}' if show_date else ''
+    )
+
+
 def to_local(dt):
     return dt.replace(tzinfo=timezone.utc).astimezone(tz=None)
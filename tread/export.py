@@ -0,0 +1,163 @@
+import json
+import sys
+from email.utils import format_datetime
+from xml.sax.saxutils import quoteattr
+from sqlalchemy import select, func, case, not_, or_, and_
+
+from .models import Feed, Item, Body
+from .opml import write_opml
+from .render import parse_content
+
+
+# Rows are read straight from a streaming cursor (without creating ORM
+# objects) and written out one at a time, so memory use stays constant no
+# matter how large the database is.
+
+
+def list_feeds(db_session, stream, filters, fmt='jsonl'):
+    feeds = Feed.__table__
+    items = Item.__table__
+
+    query = select(
+        feeds.c.name, feeds.c.url, feeds.c.main_url, feeds.c.last_refresh,
+        func.count(items.c.id).label('items'),
+        func.coalesce(
+            func.sum(case((not_(items.c.read), 1), else_=0)), 0
+        ).label('unread'),
+        func.coalesce(
+            func.sum(case((items.c.starred, 1), else_=0)), 0
+        ).label('starred')
+    ).select_from(
+        # Only the items that match the filters are counted, but every feed
+        # is still listed.
+        feeds.outerjoin(
+            items, and_(
+                items.c.feed_id == feeds.c.id, *item_filters(items, filters)
+            )
+        )
+    ).group_by(feeds.c.id).order_by(feeds.c.id)
+
+    if filters.get('feeds'):
+        query = query.where(feed_filter(feeds, filters))
+
+    rows = stream_rows(db_session, query)
+
+    if fmt == 'opml':
+        write_opml(rows, stream)
+        return
+
+    for row in rows:
+        record = dict(row._mapping)
+        record['last_refresh'] = isoformat(record['last_refresh'])
+        stream.write(json.dumps(record) + '\n')
+
+
+def export_items(
+    db_session, stream, filters, fmt='jsonl', config=None, width=None
+):
+    feeds = Feed.__table__
+    items = Item.__table__
+    bodies = Body.__table__
+
+    query = select(
+        feeds.c.name.label('feed'), feeds.c.url.label('feed_url'),
+        items.c.id, items.c.guid, items.c.title, items.c.url, items.c.date,
+        items.c.read, items.c.starred,
+        func.coalesce(bodies.c.content, items.c.content).label('content')
+    ).select_from(items.join(feeds).outerjoin(bodies)) \
+        .order_by(feeds.c.id, items.c.date.desc())
+
+    if filters.get('feeds'):
+        query = query.where(feed_filter(feeds, filters))
+    query = query.where(*item_filters(items, filters))
+
+    rows = stream_rows(db_session, query)
+
+    if fmt == 'opml':
+        write_items_opml(rows, stream)
+        return
+
+    for row in rows:
+        record = dict(row._mapping)
+        record['date'] = isoformat(record['date'])
+
+        if width:
+            # Plain-text render (without images, which would need fetching).
+            record['text'] = parse_content(
+                record['content'] or '', config, width, log
+            )
+
+        stream.write(json.dumps(record) + '\n')
+
+
+def feed_filter(feeds, filters):
+    return or_(
+        feeds.c.name.in_(filters['feeds']), feeds.c.url.in_(filters['feeds'])
+    )
+
+
+def item_filters(items, filters):
+    conditions = []
+
+    if filters.get('unread'):
+        conditions.append(not_(items.c.read))
+    if filters.get('starred'):
+        conditions.append(items.c.starred)
+    if filters.get('since'):
+        conditions.append(items.c.date >= filters['since'])
+    if filters.get('until'):
+        conditions.append(items.c.date < filters['until'])
+
+    return conditions
+
+
+def write_items_opml(rows, stream):
+    stream.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    stream.write('<opml version="2.0">\n')
+    stream.write('  <head><title>tread items</title></head>\n')
+    stream.write('  <body>\n')
+
+    # Rows are ordered by feed, so group each feed's items under an outline.
+    feed = None
+    for row in rows:
+        if row.feed_url != feed:
+            if feed is not None:
+                stream.write('    </outline>\n')
+
+            feed = row.feed_url
+            stream.write(
+                '    <outline type="rss" text={} xmlUrl={}>\n'.format(
+                    quoteattr(row.feed or row.feed_url),
+                    quoteattr(row.feed_url)
+                )
+            )
+
+        stream.write(
+            '      <outline type="link" text={} url={} created={} />\n'.format(
+                quoteattr(row.title or ''), quoteattr(row.url or ''),
+                # OPML uses RFC 822 dates.
+                quoteattr(format_datetime(row.date) if row.date else '')
+            )
+        )
+
+    if feed is not None:
+        stream.write('    </outline>\n')
+
+    stream.write('  </body>\n')
+    stream.write('</opml>\n')
+
+
+def stream_rows(db_session, query):
+    connection = db_session.connection().execution_options(
+        stream_results=True
+    )
+
+    yield from connection.execute(query)
+
+
+def isoformat(dt):
+    return dt.isoformat() if dt else None
+
+
+def log(message):
+    print(message, file=sys.stderr)
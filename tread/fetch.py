@@ -0,0 +1,264 @@
+import os
+import random
+import socket
+import threading
+import time
+import requests
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+
+class ResponseTooLarge(requests.RequestException):
+    pass
+
+
+class Cancelled(requests.RequestException):
+    pass
+
+
+class Host:
+    def __init__(self, connections, interval):
+        # Each host gets its own connection pool, so one slow host can't tie
+        # up the connections needed for every other host.
+        self.session = requests.Session()
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=connections, max_retries=0
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # Limits on how hard the host gets hit.
+        self.slots = threading.Semaphore(connections)
+        self.interval = interval
+        self.next_request = 0
+        self.lock = threading.Lock()
+
+    def wait(self, closed, deadline):
+        # Space requests to the host at least interval seconds apart, unless
+        # that would take past the deadline.
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_request)
+            if start >= deadline:
+                return False
+            self.next_request = start + self.interval
+
+        if start > now:
+            closed.wait(start - now)
+
+        return True
+
+
+class Fetcher:
+    retry_statuses = {429, 500, 502, 503, 504}
+
+    def __init__(self, config):
+        self.config = config
+        self.retries = config.get('retries', 3)
+        self.timeout = config.get('timeout', 10)
+        self.max_bytes = config.get('max_response_bytes', 10000000)
+        self.backoff = config.get('backoff', 0.5)
+        self.max_backoff = config.get('max_backoff', 60)
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+        # Feeds and images are limited separately, so that images (which the
+        # reader is waiting on) aren't spaced out like feed refreshes.
+        self.limits = {
+            'feeds': (
+                config.get('host_connections', 2),
+                config.get('host_interval', 0.5)
+            ),
+            'images': (
+                config.get('image_connections', 4),
+                config.get('image_interval', 0)
+            ),
+        }
+
+        # Images in the item being opened don't wait behind prefetches.
+        self.limits['opened'] = self.limits['images']
+
+        # Set on exit, to stop downloads that are still in progress.
+        self.closed = threading.Event()
+        self.active = set()
+
+    def host(self, url, bucket):
+        key = (bucket, urlsplit(url).netloc.lower())
+
+        with self.lock:
+            if key not in self.hosts:
+                self.hosts[key] = Host(*self.limits[bucket])
+
+            return self.hosts[key]
+
+    def get(
+        self, url, timeout=None, max_bytes=None, retries=None, bucket='feeds'
+    ):
+        timeout = timeout if timeout is not None else self.timeout
+        max_bytes = max_bytes if max_bytes is not None else self.max_bytes
+        retries = retries if retries is not None else self.retries
+        host = self.host(url, bucket)
+
+        for attempt in range(retries + 1):
+            last_attempt = attempt == retries
+            delay = None
+
+            try:
+                r = self.attempt(host, url, timeout, max_bytes)
+            except (ResponseTooLarge, Cancelled):
+                raise
+            except requests.RequestException:
+                if last_attempt:
+                    raise
+            else:
+                retry = r.status_code in self.retry_statuses
+                if last_attempt or not retry:
+                    return r
+                delay = retry_after(r)
+
+            if delay is None:
+                # Exponential backoff with full jitter.
+                delay = random.uniform(
+                    0, min(self.max_backoff, self.backoff * 2 ** attempt)
+                )
+
+            self.closed.wait(min(delay, self.max_backoff))
+
+    def attempt(self, host, url, timeout, max_bytes):
+        # Time spent waiting for the host counts towards the timeout.
+        deadline = time.monotonic() + timeout
+
+        if not host.wait(self.closed, deadline) or not host.slots.acquire(
+            timeout=max(deadline - time.monotonic(), 0)
+        ):
+            raise requests.Timeout(f'{url} timed out waiting for its host')
+
+        try:
+            if self.closed.is_set():
+                raise Cancelled(f'{url} was cancelled')
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise requests.Timeout(f'{url} timed out waiting for its host')
+
+            return self.request(host, url, remaining, max_bytes)
+        finally:
+            host.slots.release()
+
+    def close(self):
+        self.closed.set()
+
+        with self.lock:
+            active = list(self.active)
+
+        for cutoff in active:
+            cutoff()
+
+    def request(self, host, url, timeout, max_bytes):
+        deadline = time.monotonic() + timeout
+
+        r = host.session.get(url, timeout=timeout, stream=True)
+
+        # The timeout passed to requests only applies to each individual
+        # read, so a server that trickles data out could hold on to the
+        # connection indefinitely. Cut it off at an overall deadline instead.
+        cutoff = Cutoff(r)
+        timer = threading.Timer(max(deadline - time.monotonic(), 0), cutoff)
+        timer.daemon = True
+        timer.start()
+
+        # Closing the fetcher cuts off every download in progress too.
+        with self.lock:
+            self.active.add(cutoff)
+        if self.closed.is_set():
+            cutoff()
+
+        try:
+            with r:
+                try:
+                    data = self.read(r, url, max_bytes)
+                finally:
+                    timer.cancel()
+                    cutoff.finish()
+
+                    with self.lock:
+                        self.active.discard(cutoff)
+
+                # Without a Content-Length, being cut off looks like the end
+                # of the response.
+                if cutoff.aborted:
+                    raise requests.Timeout(f'{url} took too long to download')
+        except requests.RequestException:
+            if self.closed.is_set():
+                raise Cancelled(f'{url} was cancelled')
+            if cutoff.aborted:
+                raise requests.Timeout(f'{url} took too long to download')
+            raise
+
+        # Let requests handle character encoding as usual.
+        r._content = bytes(data)
+        return r
+
+    def read(self, r, url, max_bytes):
+        length = r.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise ResponseTooLarge(f'{url} is larger than {max_bytes} bytes')
+
+        # The size limit applies after decompression.
+        data = bytearray()
+        for chunk in r.iter_content(16384):
+            data += chunk
+            if len(data) > max_bytes:
+                raise ResponseTooLarge(
+                    f'{url} is larger than {max_bytes} bytes'
+                )
+
+        return data
+
+
+class Cutoff:
+    # Aborts a response that is being read by another thread.
+    def __init__(self, r):
+        self.r = r
+        self.aborted = False
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            # Once the response is closed, its file descriptor may be reused.
+            if self.finished:
+                return
+
+            self.aborted = True
+
+            try:
+                sock = socket.socket(fileno=os.dup(self.r.raw.fileno()))
+            except (OSError, ValueError):
+                return
+
+            # Shutting the socket down wakes up any read that is blocked on it.
+            with sock:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def finish(self):
+        with self.lock:
+            self.finished = True
+
+
+def retry_after(r):
+    value = r.headers.get('Retry-After')
+
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
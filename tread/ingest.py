@@ -0,0 +1,166 @@
+import re
+from bs4 import BeautifulSoup
+from datetime import datetime, timedelta, timezone
+from dateutil.parser import parse
+from functools import lru_cache
+from hashlib import sha1
+from html import unescape
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+
+MONTHS = {
+    month: i + 1 for i, month in enumerate(
+        ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct',
+         'nov', 'dec')
+    )
+}
+
+UTC_NAMES = {'GMT', 'UT', 'UTC', 'Z'}
+
+# Query parameters that only track where a link was shared.
+TRACKING_PARAMETERS = ('utm_', 'fbclid', 'gclid', 'mc_cid', 'mc_eid')
+
+# E.g., "Mon, 01 Jan 2024 10:00:00 GMT" (pubDate in RSS 2.0).
+RFC_822 = re.compile(
+    r'\s*(?:[A-Za-z]{3},\s*)?(\d{1,2})\s+([A-Za-z]{3})\s+(\d{4})\s+'
+    r'(\d{1,2}):(\d{2})(?::(\d{2}))?\s*([+-]\d{4}|[A-Za-z]+)?\s*$'
+)
+
+# E.g., "2024-01-01T10:00:00.000+02:00" (common in Atom and dc:date).
+RFC_3339 = re.compile(
+    r'\s*(\d{4})-(\d{2})-(\d{2})[Tt ](\d{2}):(\d{2}):(\d{2})'
+    r'(?:\.(\d{1,6})\d*)?\s*([Zz]|[+-]\d{2}:?\d{2})?\s*$'
+)
+
+
+# Converts raw feed XML into plain records. This doesn't touch the database,
+# so it can run in a separate process and its results can be pickled.
+def parse_feed(xml):
+    soup = BeautifulSoup(xml, 'xml')
+
+    # TODO: Add support for ATOM feeds as well.
+
+    items = []
+    for item in soup.find_all('item'):
+        url = string(item.link)
+        content = unescape(
+            string(item.find('content:encoded') or item.description)
+        )
+
+        items.append({
+            'guid': string(item.guid) if item.guid else url,
+            'title': unescape(string(item.title) or ''),
+            'url': url,
+            'date': parse_date(string(item.pubDate)),
+            'content': content,
+            'identity': identity(url, content),
+        })
+
+    return {
+        'main_url': string(soup.channel.link),
+        'description': string(soup.channel.description),
+        'items': items,
+    }
+
+
+# Identifies the same article republished in several feeds (e.g., by an
+# aggregator), no matter which feed it came from.
+def identity(url, content):
+    content_hash = sha1(content.encode('utf-8')).hexdigest()
+    return sha1(
+        f'{canonical_url(url)}\n{content_hash}'.encode('utf-8')
+    ).hexdigest()
+
+
+def canonical_url(url):
+    if not url:
+        return ''
+
+    parts = urlsplit(url.strip())
+
+    # Ignore the scheme, "www.", default ports, fragments and tracking.
+    host = (parts.hostname or '').removeprefix('www.')
+    if parts.port not in (None, 80, 443):
+        host += f':{parts.port}'
+
+    query = [
+        (key, value)
+        for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith(TRACKING_PARAMETERS)
+    ]
+
+    return urlunsplit(
+        ('', host, parts.path.rstrip('/') or '/', urlencode(query), '')
+    )
+
+
+def string(tag):
+    # NavigableStrings hold a reference to the whole parse tree, so convert
+    # them to plain strings.
+    return str(tag.string) if tag.string is not None else None
+
+
+# Feeds repeat the same dates on every refresh (and often within a single
+# feed), so remember the results. Datetimes are immutable, so sharing is safe.
+@lru_cache(maxsize=4096)
+def parse_date(value):
+    # Handle the standard formats directly, which is much faster than
+    # dateutil's general-purpose parser. Anything else goes to dateutil.
+    try:
+        return parse_rfc_822(value) or parse_rfc_3339(value) or parse(value)
+    except ValueError:
+        return parse(value)
+
+
+def parse_rfc_822(value):
+    match = RFC_822.match(value)
+    month = MONTHS.get(match.group(2).lower()) if match else None
+
+    if not month:
+        return None
+
+    day, _, year, hour, minute, second, zone = match.groups()
+
+    if zone is None:
+        tz = None
+    elif zone.upper() in UTC_NAMES:
+        tz = timezone.utc
+    elif zone[0] in '+-':
+        tz = offset(zone)
+    else:
+        # Other zone names are ambiguous; leave them to dateutil.
+        return None
+
+    return datetime(
+        int(year), month, int(day), int(hour), int(minute), int(second or 0),
+        tzinfo=tz
+    )
+
+
+def parse_rfc_3339(value):
+    match = RFC_3339.match(value)
+
+    if not match:
+        return None
+
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+
+    if zone is None:
+        tz = None
+    elif zone in 'Zz':
+        tz = timezone.utc
+    else:
+        tz = offset(zone)
+
+    return datetime(
+        int(year), int(month), int(day), int(hour), int(minute), int(second),
+        int(fraction.ljust(6, '0')) if fraction else 0, tzinfo=tz
+    )
+
+
+def offset(zone):
+    # Accepts +hhmm or +hh:mm.
+    digits = zone[1:].replace(':', '')
+    minutes = int(digits[:2]) * 60 + int(digits[2:])
+
+    return timezone(timedelta(minutes=-minutes if zone[0] == '-' else minutes))
@@ -1,12 +1,17 @@
 import curses
-from dateutil.parser import parse
+import re
+import sys
+from collections import OrderedDict
 from datetime import datetime
-from bs4 import BeautifulSoup
-from html import unescape
-from sqlalchemy import Column, ForeignKey
+from sqlalchemy import (
+    Column, ForeignKey, func, case, not_, exists, inspect, text
+)
 from sqlalchemy import Integer, Unicode, UnicodeText, DateTime, Boolean
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred
 from sqlalchemy.ext.declarative import declarative_base
+from wcwidth import wcwidth
+
+from .ingest import parse_feed
 
 
 Base = declarative_base()
@@ -42,64 +47,81 @@ class Feed(Base):
         return len(list(filter(lambda item: item.starred, self.items)))
 
     # Update object from web and write back to DB.
-    def refresh(self, db_session, www_session, timeout, log=print):
+    def refresh(self, db_session, fetcher, timeout, log=print, retries=None):
         log('Refreshing {}...'.format(self.name))
-        try:
-            r = www_session.get(self.url, timeout=timeout)
-        except:
-            log('Unable to refresh: no response from {}.'.format(self.url))
-            return
+        xml = download(fetcher, self.url, timeout, log, retries)
 
-        if r.status_code != 200:
-            log(
-                'Unable to refresh: {} responded with {}.'.format(
-                    self.url, r.status_code
-                )
-            )
-            return
+        if xml is not None:
+            self.update(db_session, parse_feed(xml))
 
-        xml = r.text
-        soup = BeautifulSoup(xml, 'xml')
+    # Discard loaded state, so that it's reloaded from the DB when next used.
+    def reload(self, db_session):
+        for item in self.__dict__.get('items', []):
+            db_session.expire(item)
 
-        # TODO: Add support for ATOM feeds as well.
+        db_session.expire(self)
 
+    # Write items parsed by parse_feed back to DB.
+    def update(self, db_session, parsed):
         # Nope, just use the name from the config file.
         # self.name = soup.channel.name.string
 
-        self.main_url = soup.channel.link.string
-        self.description = soup.channel.description.string
-
-        for item in soup.find_all('item'):
-            guid = item.guid.string if item.guid else item.link.string
-            row = db_session.query(Item).filter(Item.feed_id == self.id) \
-                .filter(Item.guid == guid).scalar()
+        self.main_url = parsed['main_url']
+        self.description = parsed['description']
+
+        # Look up all of the existing items at once.
+        guids = [item['guid'] for item in parsed['items']]
+        rows = {
+            row.guid: row for row in db_session.query(Item)
+            .filter(Item.feed_id == self.id).filter(Item.guid.in_(guids))
+        }
+
+        # Items that other feeds have already published share their body, and
+        # are read if any of the copies have been read.
+        identities = {item['identity'] for item in parsed['items']}
+        bodies = {
+            body.identity: body for body in db_session.query(Body)
+            .filter(Body.identity.in_(identities))
+        }
+        read = {
+            identity for identity, in db_session.query(Item.identity)
+            .filter(Item.identity.in_(identities)).filter(Item.read)
+        }
+
+        # Edited items get a new body, and the old one may not be needed.
+        replaced = set()
+
+        for item in parsed['items']:
+            body = bodies.get(item['identity'])
+
+            if not body:
+                body = Body(identity=item['identity'], content=item['content'])
+                bodies[body.identity] = body
+                db_session.add(body)
+
+            row = rows.get(item['guid'])
 
             if row:
                 # Update the item.
-                row.title = unescape(
-                    item.title.string if item.title.string else ''
-                )
-                row.url = item.link.string
-                row.date = parse(item.pubDate.string)
-                row.content = unescape(
-                    (item.find('content:encoded') or item.description).string
-                )
+                row.title = item['title']
+                row.url = item['url']
+                row.date = item['date']
+
+                # Only replace the body if it has actually changed.
+                if row.identity != body.identity:
+                    if row.identity:
+                        replaced.add(row.identity)
+                    row.body = body
+                    row.stored_content = None
 
             else:
                 # Create the item.
                 row = Item(
-                    guid=guid,
-                    title=unescape(
-                        item.title.string if item.title.string else ''
-                    ),
-                    url=item.link.string,
-                    date=parse(item.pubDate.string),
-                    content=unescape(
-                        (
-                            item.find('content:encoded') or item.description
-                        ).string
-                    )
+                    guid=item['guid'], title=item['title'], url=item['url'],
+                    date=item['date'], body=body,
+                    read=item['identity'] in read
                 )
+                rows[row.guid] = row
                 self.items.append(row)
 
         # Feed has been refreshed.
@@ -107,9 +129,50 @@ class Feed(Base):
 
         # Write back to DB.
         db_session.add(self)
+        db_session.flush()
+
+        # Delete the replaced bodies that no other copies still use.
+        if replaced:
+            db_session.query(Body).filter(Body.identity.in_(replaced)).filter(
+                ~exists().where(Item.identity == Body.identity)
+            ).delete(synchronize_session='fetch')
+
         db_session.commit()
 
 
+def refreshed_since(db_session, since):
+    # This is polled, so check whether anything has changed at all before
+    # looking for the feeds that did.
+    latest = db_session.query(func.max(Feed.last_refresh)).scalar()
+
+    if latest is None or (since is not None and latest <= since):
+        return since, []
+
+    query = db_session.query(Feed.id)
+    if since is not None:
+        query = query.filter(Feed.last_refresh > since)
+
+    return latest, [feed_id for feed_id, in query]
+
+
+def download(fetcher, url, timeout, log=print, retries=None):
+    try:
+        r = fetcher.get(url, timeout=timeout, retries=retries)
+    except:
+        log('Unable to refresh: no response from {}.'.format(url))
+        return None
+
+    if r.status_code != 200:
+        log(
+            'Unable to refresh: {} responded with {}.'.format(
+                url, r.status_code
+            )
+        )
+        return None
+
+    return r.text
+
+
 class Item(Base):
     __tablename__ = 'items'
 
@@ -118,13 +181,109 @@ class Item(Base):
     title = Column(Unicode)
     url = Column(Unicode)
     date = Column(DateTime)
-    content = Column(UnicodeText)
     read = Column(Boolean, default=False)
     starred = Column(Boolean, default=False)
 
+    # Items stored before bodies were shared keep their content here.
+    stored_content = deferred(Column('content', UnicodeText))
+
+    # Bodies are only loaded when they're needed for rendering.
+    identity = Column(Unicode, ForeignKey('bodies.identity'), index=True)
+    body = relationship('Body')
+
     feed_id = Column(Integer, ForeignKey('feeds.id'))
     feed = relationship('Feed', back_populates='items')
 
+    @property
+    def content(self):
+        return self.body.content if self.body else self.stored_content
+
+    @property
+    def render_key(self):
+        # Copies of the same item in different feeds share rendered output.
+        return self.identity or self.id
+
+    def set_read(self, db_session, read=True):
+        # Mark every copy of the item (in any feed), returning their feeds.
+        self.read = read
+        if not self.identity:
+            return {self.feed_id}
+
+        copies = db_session.query(Item) \
+            .filter(Item.identity == self.identity).all()
+        for copy in copies:
+            copy.read = read
+
+        return {copy.feed_id for copy in copies}
+
+
+class Body(Base):
+    __tablename__ = 'bodies'
+
+    identity = Column(Unicode, primary_key=True)
+    content = Column(UnicodeText)
+
+
+def migrate(engine):
+    # create_all doesn't add new columns to existing tables.
+    columns = inspect(engine).get_columns('items')
+
+    if 'identity' not in {column['name'] for column in columns}:
+        with engine.begin() as connection:
+            connection.execute(
+                text('ALTER TABLE items ADD COLUMN identity VARCHAR')
+            )
+            connection.execute(
+                text('CREATE INDEX ix_items_identity ON items (identity)')
+            )
+
+
+class FeedCache:
+    # Keeps the items of only the most recently viewed feeds loaded. Loaded
+    # objects are only held by the session's identity map while something
+    # references them, so releasing a feed's items lets them be collected.
+    def __init__(self, db_session, max_feeds=3, max_items=2000):
+        self.db_session = db_session
+        self.max_feeds = max_feeds
+        self.max_items = max_items
+        self.feeds = OrderedDict()
+
+    def touch(self, feed):
+        self.feeds[feed.id] = feed
+        self.feeds.move_to_end(feed.id)
+
+        # Evict the least recently viewed feeds (but never the current one).
+        while len(self.feeds) > 1 and (
+            len(self.feeds) > self.max_feeds or self.items > self.max_items
+        ):
+            _, oldest = self.feeds.popitem(last=False)
+            self.evict(oldest)
+
+    def evict(self, feed):
+        self.feeds.pop(feed.id, None)
+        self.db_session.expire(feed, ['items'])
+
+    @property
+    def items(self):
+        return sum(
+            len(feed.__dict__['items']) for feed in self.feeds.values()
+            if 'items' in feed.__dict__
+        )
+
+    def stats(self):
+        # Approximate, since only the loaded column values are counted.
+        items = 0
+        size = 0
+        for obj in list(self.db_session.identity_map.values()):
+            if isinstance(obj, (Item, Body)):
+                items += isinstance(obj, Item)
+                size += sum(
+                    sys.getsizeof(value) for value in obj.__dict__.values()
+                    if isinstance(value, str)
+                )
+
+        return items, size
+
 
 class Window:
     border_height = 1
@@ -278,3 +437,122 @@ class Window:
         self.pad = curses.newpad(self.max_lines, self.width)
 
         self.refresh_border()
+
+
+class Sidebar(Window):
+    def __init__(
+        self, screen, height, width, row_offset=0, col_offset=0, title=''
+    ):
+        # The pad only needs to hold the rows that are actually visible, plus
+        # one more for the cursor to move to after the (full-width) last row.
+        border = Window.border_height
+        super().__init__(
+            screen, height, width, row_offset, col_offset,
+            max_lines=max(height - 2 * border, 1) + 1, title=title
+        )
+
+        self.label = None
+        self.length = 0
+        self.selected = 0
+        self.top = 0
+
+    def show(self, length, selected, label):
+        # label takes a list of row indices and returns the text of each row.
+        self.length = length
+        self.selected = selected
+        self.label = label
+        self.redraw()
+
+    def select(self, index):
+        previous = self.selected
+        self.selected = index
+
+        if self.visible(index):
+            # Only the previous and new selections need to change.
+            self.draw_rows([previous, index])
+        else:
+            self.redraw()
+
+    def update(self, index):
+        self.draw_rows([index])
+
+    def redraw(self):
+        # Scroll (if necessary) so that the selection is visible.
+        if self.selected < self.top:
+            self.top = self.selected
+        elif self.selected >= self.top + self.height:
+            self.top = self.selected - self.height + 1
+
+        self.clear()
+        self.draw_rows(range(self.top, self.top + self.height))
+
+    def visible(self, index):
+        return self.top <= index < min(self.top + self.height, self.length)
+
+    def draw_rows(self, indices):
+        indices = [i for i in dict.fromkeys(indices) if self.visible(i)]
+
+        if self.label and indices:
+            for i, text in zip(indices, self.label(indices)):
+                # Rows are only redrawn individually, so a label that wrapped
+                # would be left over the row below it.
+                self.write(
+                    fit(text, self.width), row_offset=i - self.top,
+                    attr=curses.A_BOLD | curses.A_REVERSE * (i==self.selected)
+                )
+
+        self.refresh()
+
+    def resize(
+        self, new_height, new_width, new_row_offset=None, new_col_offset=None
+    ):
+        self.max_lines = max(new_height - 2 * Window.border_height, 1) + 1
+        super().resize(new_height, new_width, new_row_offset, new_col_offset)
+        self.redraw()
+
+
+def fit(text, width):
+    # Cut text to exactly width columns, keeping any unread/starred count
+    # (e.g., " (12, *3)") on the end visible.
+    name, suffix = re.match(r'(.*?)( \([\d, *]+\))?$', text, re.S).groups()
+    suffix = suffix or ''
+    if columns(suffix) >= width:
+        name, suffix = text, ''
+
+    # Double-width characters take up two columns.
+    used = columns(suffix)
+    for i, char in enumerate(name):
+        if used + columns(char) > width:
+            name = name[:i]
+            break
+        used += columns(char)
+
+    return name + suffix + ' ' * (width - used)
+
+
+def columns(text):
+    return sum(max(wcwidth(char), 0) for char in text)
+
+
+def feed_counts(db_session, feed_ids):
+    # Count unread and starred items for several feeds in a single query.
+    rows = db_session.query(
+        Item.feed_id,
+        func.sum(case((not_(Item.read), 1), else_=0)),
+        func.sum(case((Item.starred, 1), else_=0))
+    ).group_by(Item.feed_id)
+
+    # Very long lists of IDs can exceed SQLite's limit on query parameters,
+    # and then it's no slower to just count every feed.
+    if len(feed_ids) <= 500:
+        rows = rows.filter(Item.feed_id.in_(feed_ids))
+
+    counts = {feed_id: (0, 0) for feed_id in feed_ids}
+    counts.update(
+        {
+            feed_id: (unread, starred) for feed_id, unread, starred in rows
+            if feed_id in counts
+        }
+    )
+
+    return counts
@@ -0,0 +1,36 @@
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+
+
+def read_opml(opml_file):
+    feeds = []
+
+    # Outlines may be nested inside category outlines, so search all of them.
+    for outline in ElementTree.parse(opml_file).iter('outline'):
+        url = outline.get('xmlUrl')
+
+        if url:
+            name = outline.get('title') or outline.get('text') or url
+            feeds.append({'name': name, 'url': url})
+
+    return feeds
+
+
+def write_opml(feeds, stream, title='tread subscriptions'):
+    # Written line by line so that large subscription lists can be streamed.
+    stream.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    stream.write('<opml version="2.0">\n')
+    stream.write(f'  <head><title>{escape(title)}</title></head>\n')
+    stream.write('  <body>\n')
+
+    for feed in feeds:
+        stream.write(
+            '    <outline type="rss" text={0} title={0} xmlUrl={1}{2} />\n'
+            .format(
+                quoteattr(feed.name or feed.url), quoteattr(feed.url),
+                f' htmlUrl={quoteattr(feed.main_url)}' if feed.main_url else ''
+            )
+        )
+
+    stream.write('  </body>\n')
+    stream.write('</opml>\n')
@@ -0,0 +1,314 @@
+import re
+import subprocess
+import threading
+import imgii
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from io import BytesIO
+from queue import Queue, Empty
+from html2text import HTML2Text
+
+from .fetch import ResponseTooLarge
+
+
+class ImageBuffer(BytesIO):
+    # imgii guesses whether its argument is a URL by calling startswith on it.
+    def startswith(self, prefix):
+        return False
+
+
+class ImageLoader:
+    def __init__(self, fetcher, config):
+        self.fetcher = fetcher
+        self.max_bytes = config.get('image_max_bytes', 2000000)
+        self.timeout = config.get('image_timeout', 5)
+        self.pool = ThreadPoolExecutor(
+            max_workers=config.get('image_workers', 4)
+        )
+
+        # Images in the item being opened skip the queue of prefetches.
+        self.urgent_pool = ThreadPoolExecutor(
+            max_workers=config.get('image_workers', 4)
+        )
+
+        # Raw image data is kept (by URL) so that images can be redrawn at a
+        # different width (e.g., after a resize) without fetching them again.
+        # Permanent failures (e.g., a 404) are cached too, so that they aren't
+        # retried.
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.max_cache_bytes = config.get('image_cache_bytes', 20000000)
+        self.max_cache_images = config.get('image_cache_images', 1000)
+        self.lock = threading.Lock()
+
+        # Images that failed in a way that might not happen again (e.g., a
+        # timeout) are only retried for the item being opened.
+        self.failed = OrderedDict()
+
+    def load(self, urls, urgent=False, failed=None):
+        # Fetch all of the images at once, rather than one after the other.
+        # Urgent requests don't wait behind prefetches, even for the same host.
+        pool, bucket = (
+            (self.urgent_pool, 'opened') if urgent else (self.pool, 'images')
+        )
+        futures = {
+            url: pool.submit(self.fetch, url, bucket) for url in set(urls)
+        }
+
+        # Give up on any images that aren't in by the timeout. Downloads
+        # that have started are still cached when they finish, so they'll
+        # appear next time; the rest aren't started at all.
+        _, late = wait(futures.values(), timeout=self.timeout)
+        for future in late:
+            future.cancel()
+
+        data = {
+            url: None if future in late else future.result()
+            for url, future in futures.items()
+        }
+
+        # Report the images that might still load if they're tried again.
+        if failed is not None:
+            with self.lock:
+                failed.update(
+                    url for url, value in data.items()
+                    if value is None and url not in self.cache
+                )
+
+        return data
+
+    def fetch(self, url, bucket='images'):
+        with self.lock:
+            if url in self.cache:
+                self.cache.move_to_end(url)
+                return self.cache[url]
+            if url in self.failed and bucket != 'opened':
+                return None
+
+        data, permanent = self.download(url, bucket)
+
+        with self.lock:
+            if not permanent:
+                self.failed[url] = True
+                while len(self.failed) > self.max_cache_images:
+                    self.failed.popitem(last=False)
+                return None
+
+            self.failed.pop(url, None)
+            if url not in self.cache:
+                self.cache[url] = data
+                self.cache_bytes += len(data or b'')
+
+            # Evict the least recently used images.
+            while len(self.cache) > 1 and (
+                self.cache_bytes > self.max_cache_bytes or
+                len(self.cache) > self.max_cache_images
+            ):
+                _, evicted = self.cache.popitem(last=False)
+                self.cache_bytes -= len(evicted or b'')
+
+        return data
+
+    def download(self, url, bucket):
+        # Returns the image (or None) and whether the result is permanent.
+        # Don't retry, so that a single image can't hold up the item.
+        try:
+            r = self.fetcher.get(
+                url, timeout=self.timeout, max_bytes=self.max_bytes,
+                retries=0, bucket=bucket
+            )
+        except ResponseTooLarge:
+            return None, True
+        except Exception:
+            # Timeouts, connection errors, etc.
+            return None, False
+
+        if r.status_code == 200:
+            return r.content, True
+
+        # Client errors won't change (except for these), but server errors
+        # might.
+        return None, 400 <= r.status_code < 500 and r.status_code not in (
+            408, 429
+        )
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.urgent_pool.shutdown(wait=False, cancel_futures=True)
+
+
+class Prefetcher:
+    def __init__(self, config, fetcher):
+        self.config = config
+        self.loader = ImageLoader(fetcher, config)
+        self.pool = ThreadPoolExecutor(
+            max_workers=config.get('prefetch_workers', 2)
+        )
+        self.cache_size = config.get('prefetch_cache', 50)
+        self.renders = OrderedDict()
+        self.messages = Queue()
+
+        # Renders that are missing images that might load if tried again.
+        self.incomplete = set()
+
+    def prefetch(self, items, width):
+        for item in items:
+            key = (item.render_key, width)
+
+            if key in self.renders:
+                self.renders.move_to_end(key)
+                continue
+
+            # Item content must be read on the main thread, because the
+            # database session isn't thread-safe.
+            self.renders[key] = self.pool.submit(
+                self.build, key, item.content, width
+            )
+
+        # Evict the least recently used renders.
+        while len(self.renders) > self.cache_size:
+            key, future = self.renders.popitem(last=False)
+            future.cancel()
+            self.incomplete.discard(key)
+
+    def render(self, item, width, retry=False):
+        key = (item.render_key, width)
+        future = self.renders.get(key)
+
+        # When an item is opened, images that failed before are tried again.
+        if retry and key in self.incomplete and future and future.done():
+            future = None
+
+        # If the item's prefetch hasn't started yet, don't wait behind the
+        # rest of the queue; render it here instead.
+        if future is None or future.cancel():
+            future = Future()
+            future.set_result(
+                self.build(key, item.content, width, urgent=True)
+            )
+            self.renders[key] = future
+
+        self.renders.move_to_end(key)
+        return future.result()
+
+    def build(self, key, content, width, urgent=False):
+        failed = set()
+        output = parse_content(
+            content, self.config, width, self.messages.put,
+            self.loader if self.images else None, urgent, failed
+        )
+
+        if failed:
+            self.incomplete.add(key)
+        else:
+            self.incomplete.discard(key)
+
+        return output
+
+    def flush(self, log):
+        # Worker threads can't write to the screen, so pass on their messages.
+        while True:
+            try:
+                log(self.messages.get_nowait())
+            except Empty:
+                break
+
+    def stats(self):
+        renders = [
+            future.result() for future in self.renders.values()
+            if future.done() and not future.cancelled()
+            and not future.exception()
+        ]
+
+        return len(renders), sum(len(render) for render in renders)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.loader.shutdown()
+
+    @property
+    def images(self):
+        return self.config.get('ascii_images')
+
+
+def parse_content(
+    content, config, width, log, loader=None, urgent=False, failed=None
+):
+    browser = config.get('parser', 'html2text')
+    images = config.get('ascii_images') and loader is not None
+    chars = imgii.BLOCKS if config.get('image_blocks') else imgii.CHARS
+
+    if images:
+        # Replace images with placeholder text, because (especially if using
+        # block characters) the images don't always survive parsing.
+        content = re.sub(
+            r'(<img\s.*?src="(https?://.+?)"[^>]*?>)',
+            r'<br/>TREAD_PLACEHOLDER \2 END_PLACEHOLDER<br/>\1',
+            content
+        )
+
+    if browser == 'lynx':
+        output = subprocess.check_output(
+            [
+                'lynx',
+                '-stdin', '-dump', '-width', str(width + 2), '-image_links'
+            ],
+            input=content.encode('iso-8859-1', 'xmlcharrefreplace'),
+            stderr=subprocess.STDOUT
+        )
+        output = output.decode('iso-8859-1', 'xmlcharrefreplace')
+        output += '\n'
+
+    elif browser == 'w3m':
+        output = subprocess.check_output(
+            ['w3m', '-T', 'text/html', '-dump', '-cols', str(width)],
+            input=content.encode('utf-8', 'xmlcharrefreplace'),
+            stderr=subprocess.STDOUT
+        )
+        output = output.decode('utf-8', 'xmlcharrefreplace')
+
+    elif browser == 'html2text':
+        handler = HTML2Text()
+        handler.body_width = width - 1
+        output = handler.handle(content)
+
+    else:
+        log(f'Unsuported browser: {browser}')
+        return content
+
+    if images:
+        placeholder = re.compile(
+            r'\n? *TREAD_PLACEHOLDER[\s\n]+?(.+?)[\s\n]+?END_PLACEHOLDER',
+            flags=re.DOTALL
+        )
+
+        # Download every image in the item concurrently.
+        data = loader.load(
+            (
+                re.sub(r'[\s\n]', '', m.group(1))
+                for m in placeholder.finditer(output)
+            ),
+            urgent, failed
+        )
+
+        def ascii_image(match):
+            url = re.sub(r'[\s\n]', '', match.group(1))
+
+            if not data.get(url):
+                log(f'Unable to load image: {url}')
+                return ''
+
+            try:
+                image = imgii.image_to_ascii(
+                    ImageBuffer(data[url]), console_width=width - 7,
+                    chars=chars
+                )
+            except Exception:
+                log(f'Unable to display image: {url}')
+                return ''
+
+            return '\n   ' + image.replace('\n', '\n   ')
+
+        output = placeholder.sub(ascii_image, output)
+
+    return output
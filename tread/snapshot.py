@@ -0,0 +1,23 @@
+import json
+import os
+
+
+# A snapshot of what was on screen when tread last exited, used to draw the
+# first frame before the database has been reconciled with the config.
+
+
+def load_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_snapshot(path, snapshot):
+    # Write to a temporary file first so a crash can't leave half a snapshot.
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(snapshot, f)
+
+    os.replace(temp_path, path)